@@ -57,3 +57,12 @@ PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 DATA_DIR = os.path.join(PROJECT_ROOT, "user_data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
+
+# storage backend (shared by every bot / web worker on the same host)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+STORAGE_DB_PATH = os.getenv("STORAGE_DB_PATH", os.path.join(DATA_DIR, "elog.db"))
+STORAGE_LOCK_TIMEOUT_SEC = float(os.getenv("STORAGE_LOCK_TIMEOUT_SEC", "30"))
+
+# batch decryption (bulk history reads)
+DECRYPT_WORKERS = int(os.getenv("DECRYPT_WORKERS", str(os.cpu_count() or 4)))
+DECRYPT_CHUNK_SIZE = int(os.getenv("DECRYPT_CHUNK_SIZE", "64"))
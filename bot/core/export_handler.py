@@ -10,7 +10,6 @@ import smtplib
 from email.message import EmailMessage
 from datetime import datetime
 from zipfile import ZipFile, ZIP_DEFLATED
-import threading
 
 # Local module imports
 from ..config import (
@@ -18,25 +17,22 @@ from ..config import (
     SMTP_EMAIL, SMTP_PASSWORD, SMTP_HOST, SMTP_PORT, client, deployment
 )
 from .data_manager import load_user_log, load_counselor_email
-from .security_utils import _decrypt_from_storage, _ensure_session_key
+from .storage import get_storage
+from .security_utils import decrypt_entries, _ensure_session_key
 from .llm_handler import load_system_content
 
-REGISTRY_LOCK = threading.Lock()
-EXPORT_REGISTRY = os.path.join(DATA_DIR, "exports_registry.json")
+def registry_lock():
+    """Exclusive section over the export registry, shared by every worker using the same storage."""
+    return get_storage().locked()
 
-def _load_registry():
-    with REGISTRY_LOCK: # Protect file access with a Lock
-        if os.path.exists(EXPORT_REGISTRY):
-            with open(EXPORT_REGISTRY, "r", encoding="utf-8") as f:
-                return json.load(f)
-        return {}
+def _get_export(token: str):
+    return get_storage().get_export(token)
 
-def _save_registry(reg):
-    with REGISTRY_LOCK: # Protect file access with a Lock
-        tmp_path = EXPORT_REGISTRY + f".tmp.{os.getpid()}"
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(reg, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_path, EXPORT_REGISTRY)
+def _put_export(token: str, meta: dict):
+    get_storage().put_export(token, meta)
+
+def _delete_export(token: str) -> bool:
+    return get_storage().delete_export(token)
 
 def _sign_token(token: str) -> str:
     mac = hmac.new(SECRET_LINK_KEY, token.encode(), hashlib.sha256).hexdigest()
@@ -65,8 +61,7 @@ def create_secure_link_with_otp(user_id: int, file_path: str, note: str = "") ->
     revoke_id = f"ACT-{datetime.now().strftime('%y%m%d')}-{secrets.choice('ABCDEFGHJKLMNPQRSTUVWXYZ')}"
 
 
-    reg = _load_registry()
-    reg[token] = {
+    _put_export(token, {
         "user_id": user_id,
         "file_path": file_path,
         "created_at": time.time(),
@@ -78,38 +73,30 @@ def create_secure_link_with_otp(user_id: int, file_path: str, note: str = "") ->
         "otp_attempts": 0,
         "locked": False,
         "revoke_id": revoke_id
-    }
-    _save_registry(reg)
+    })
     return f"{BASE_URL}/secure-download?token={signed}", otp_plain, revoke_id
 
 def revoke_secure_link(token: str) -> bool:
-    reg = _load_registry()
-    if token in reg:
-        try:
-            if os.path.exists(reg[token]["file_path"]):
-                os.remove(reg[token]["file_path"])
-        except Exception as e:
-            logging.error(f"Failed to remove file on revoke: {e}")
-        del reg[token]
-        _save_registry(reg)
-        return True
-    return False
+    storage = get_storage()
+    with storage.locked():
+        meta = storage.get_export(token)
+        if meta is None:
+            return False
+        storage.delete_export(token)
+    try:
+        if os.path.exists(meta["file_path"]):
+            os.remove(meta["file_path"])
+    except Exception as e:
+        logging.error(f"Failed to remove file on revoke: {e}")
+    return True
 
 def find_and_revoke_by_id(user_id: int, revoke_id: str) -> tuple[bool, str]:
     """Finds and revokes a link using a user-facing ID."""
-    reg = _load_registry()
-    token_to_revoke = None
-    note = ""
-    
-    for token, meta in reg.items():
-        if int(meta.get("user_id")) == user_id and str(meta.get("revoke_id")) == revoke_id:
-            token_to_revoke = token
-            note = meta.get("note", "")
-            break
-    
-    if token_to_revoke:
-        was_revoked = revoke_secure_link(token_to_revoke)
-        return was_revoked, note
+    found = get_storage().find_export(user_id, revoke_id)
+    if found:
+        token, meta = found
+        was_revoked = revoke_secure_link(token)
+        return was_revoked, meta.get("note", "")
     
     return False, ""
 
@@ -126,11 +113,9 @@ def send_logs_via_secure_link(user_id, start_date, end_date):
 
     _ensure_session_key(user_id)
 
-    log_path = os.path.join(DATA_DIR, f"{user_id}.json")
-    if not os.path.exists(log_path):
-        return None, "Conversation history does not exist."
-
     full = load_user_log(user_id)
+    if not full:
+        return None, "Conversation history does not exist."
     
     # Compare dates accurately with datetime objects instead of string comparison
     try:
@@ -147,11 +132,10 @@ def send_logs_via_secure_link(user_id, start_date, end_date):
         return None, f"No conversation history found for the period {start_date} ~ {end_date}."
 
     pairs = []
-    for e in filtered[:30]:
+    selected = filtered[:30]
+    for e, (content, err) in zip(selected, decrypt_entries(user_id, selected)):
         role = "User" if e["role"] == "user" else "Chatbot"
-        try:
-            content = _decrypt_from_storage(user_id, e["content_enc"])
-        except Exception:
+        if err is not None:
             content = "(Decryption of past messages not possible due to security policy)"
         pairs.append(f"{role}: {content}")
     dialogue_text = "\n".join(pairs)
@@ -1,32 +1,31 @@
-import os
 import base64
 import secrets
 import hashlib
 import hmac
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 
 # Local module imports
-from ..config import MASTER_KEY, DATA_DIR
+from ..config import MASTER_KEY, DECRYPT_WORKERS, DECRYPT_CHUNK_SIZE
+from .storage import get_storage
 
 
 def _ensure_session_key(user_id: int) -> bytes:
     """
-    Obtains/generates a persistent session key for each user from a file.
-    - The key is saved to disk, so the same key is used even after a server restart.
+    Obtains/generates a persistent session key for each user from the storage backend.
+    - The key is persisted, so the same key is used even after a server restart.
+    - If two workers generate a key at the same time, the first one stored wins and both use it.
     """
-    KEY_STORAGE_DIR = os.path.join(DATA_DIR, "user_keys")
-    os.makedirs(KEY_STORAGE_DIR, exist_ok=True)
-    user_key_path = os.path.join(KEY_STORAGE_DIR, f"{user_id}.key")
-
-    # 1. Check if the user's persistent key file exists
-    if os.path.exists(user_key_path):
-        # 2. If it exists, read the saved key and return it
-        with open(user_key_path, "rb") as f:
-            key = f.read()
-    else:
-        # 3. If not, generate a new key and save it to a file
+    storage = get_storage()
+
+    # 1. Check if the user's persistent key exists
+    key = storage.load_key(user_id)
+    if key is None:
+        # 2. If not, generate a new key and save it
         seed = secrets.token_bytes(32)
         
         # Pass all required arguments to HKDF correctly
@@ -36,12 +35,7 @@ def _ensure_session_key(user_id: int) -> bytes:
             salt=hashlib.sha256(f"{user_id}".encode()).digest(),
             info=b"act-bot-session-persistent-v1" # Changed info as it's a persistent storage method
         )
-        key = hkdf.derive(MASTER_KEY + seed)
-        
-        # Save the generated key to disk as a file (only once)
-        os.umask(0o077) # Set file permissions
-        with open(user_key_path, "wb") as f:
-            f.write(key)
+        key = storage.save_key_if_absent(user_id, hkdf.derive(MASTER_KEY + seed))
 
     return key
 
@@ -55,15 +49,61 @@ def _encrypt_for_storage(user_id: int, plaintext: str) -> dict:
     return {"alg":"AES-GCM","iv":base64.b64encode(iv).decode(),
             "ct":base64.b64encode(ct).decode()}
 
-def _decrypt_from_storage(user_id: int, enc: dict) -> str:
-    
-    key = _ensure_session_key(user_id)
-    aes = AESGCM(key)
+def _decrypt_with(aes: AESGCM, enc: dict) -> str:
     iv = base64.b64decode(enc["iv"])
     ct = base64.b64decode(enc["ct"])
     pt = aes.decrypt(iv, ct, None)
     return pt.decode("utf-8")
 
+def _decrypt_chunk(aes: AESGCM, chunk: list) -> list:
+    out = []
+    for e in chunk:
+        try:
+            out.append((_decrypt_with(aes, e["content_enc"]), None))
+        except Exception as err:
+            out.append((None, err))
+    return out
+
+def decrypt_entries(user_id: int, entries, chunk_size: int = DECRYPT_CHUNK_SIZE, max_workers: int = DECRYPT_WORKERS):
+    """
+    Purpose: Decrypts many stored log entries of one user, in chunks across a thread pool.
+    The session key is looked up once and a single cipher is shared by all chunks.
+
+    Parameters:
+        user_id (int), entries (iterable of log entries with "content_enc"),
+        chunk_size (int), max_workers (int)
+
+    Returns:
+        A generator of (plaintext, error) per entry, in input order. A failed entry yields (None, exception)
+        and does not abort the rest of the batch. Raises ValueError right away for
+        chunk_size or max_workers below 1.
+    """
+    if chunk_size < 1 or max_workers < 1:
+        raise ValueError(f"chunk_size and max_workers must be >= 1 (got {chunk_size}, {max_workers})")
+    return _decrypt_entries_iter(AESGCM(_ensure_session_key(user_id)), iter(entries), chunk_size, max_workers)
+
+def _decrypt_entries_iter(aes: AESGCM, it, chunk_size: int, max_workers: int):
+    first = list(islice(it, chunk_size))
+    second = list(islice(it, chunk_size))
+
+    # A single chunk is not worth the pool overhead
+    if not second:
+        yield from _decrypt_chunk(aes, first)
+        return
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque([pool.submit(_decrypt_chunk, aes, first), pool.submit(_decrypt_chunk, aes, second)])
+    try:
+        for chunk in iter(lambda: list(islice(it, chunk_size)), []):
+            pending.append(pool.submit(_decrypt_chunk, aes, chunk))
+            # Keep a bounded number of chunks in flight so results stream instead of piling up
+            if len(pending) >= max_workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
 def _chain_key():
     return hashlib.sha256(MASTER_KEY + b":chain").digest()
 
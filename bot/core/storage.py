@@ -0,0 +1,355 @@
+import os
+import re
+import json
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+# Local module imports
+from ..config import DATA_DIR, STORAGE_BACKEND, STORAGE_DB_PATH, STORAGE_LOCK_TIMEOUT_SEC
+
+
+class StorageBackend(ABC):
+    """
+    Interface for everything the bot persists: user logs, user configs, session keys
+    and the export registry.
+
+    Every single call is atomic on its own. Read-modify-write sequences must run
+    inside `with backend.locked():`, which is exclusive across threads AND processes,
+    so several bot / web workers can share one backend on the same host.
+    """
+
+    @abstractmethod
+    def locked(self):
+        """Returns a context manager for an exclusive, re-entrant read-modify-write section."""
+
+    # user logs
+    @abstractmethod
+    def load_user_log(self, user_id, last_n=None) -> list:
+        ...
+
+    @abstractmethod
+    def save_user_log(self, user_id, log: list):
+        ...
+
+    @abstractmethod
+    def append_log_entry(self, user_id, entry: dict):
+        ...
+
+    @abstractmethod
+    def last_log_entry(self, user_id):
+        ...
+
+    # user configs
+    @abstractmethod
+    def load_config(self, user_id) -> dict:
+        ...
+
+    @abstractmethod
+    def save_config(self, user_id, config: dict):
+        ...
+
+    # session keys
+    @abstractmethod
+    def load_key(self, user_id):
+        ...
+
+    @abstractmethod
+    def save_key_if_absent(self, user_id, key: bytes) -> bytes:
+        """Stores `key` unless one already exists. Returns the key that is actually stored."""
+
+    # export registry
+    @abstractmethod
+    def get_export(self, token: str):
+        ...
+
+    @abstractmethod
+    def put_export(self, token: str, meta: dict):
+        ...
+
+    @abstractmethod
+    def delete_export(self, token: str) -> bool:
+        ...
+
+    @abstractmethod
+    def find_export(self, user_id, revoke_id: str):
+        """Returns (token, meta) of a user's export by its user-facing revoke ID, or None."""
+
+    @abstractmethod
+    def list_exports(self) -> dict:
+        ...
+
+    # one-time migrations
+    @abstractmethod
+    def has_marker(self, name: str) -> bool:
+        ...
+
+    @abstractmethod
+    def set_marker(self, name: str):
+        ...
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS log_entries (
+    user_id TEXT NOT NULL,
+    seq     INTEGER NOT NULL,
+    entry   TEXT NOT NULL,
+    PRIMARY KEY (user_id, seq)
+);
+CREATE TABLE IF NOT EXISTS user_configs (
+    user_id TEXT PRIMARY KEY,
+    config  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_keys (
+    user_id TEXT PRIMARY KEY,
+    key     BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS exports (
+    token     TEXT PRIMARY KEY,
+    user_id   TEXT NOT NULL,
+    revoke_id TEXT NOT NULL,
+    meta      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS exports_by_revoke_id ON exports (user_id, revoke_id);
+CREATE TABLE IF NOT EXISTS markers (
+    name TEXT PRIMARY KEY
+);
+"""
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    SQLite (WAL mode) backend.
+    - One connection per thread; readers never block the writer.
+    - `locked()` opens a BEGIN IMMEDIATE transaction, which takes SQLite's write lock
+      and therefore serializes read-modify-write sections across processes.
+    """
+
+    def __init__(self, db_path: str, timeout: float = 30.0):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        os.umask(0o077) # Set file permissions
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: autocommit, transactions are opened explicitly in locked()
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            conn.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def locked(self):
+        conn = self._conn()
+        if self._local.depth: # Re-entrant: already inside a transaction on this thread
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            # SQLite may already have rolled back on its own (e.g. SQLITE_FULL, I/O error);
+            # a second ROLLBACK would then mask the original exception
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    # user logs
+    def load_user_log(self, user_id, last_n=None) -> list:
+        if last_n is None:
+            rows = self._conn().execute(
+                "SELECT entry FROM log_entries WHERE user_id = ? ORDER BY seq", (str(user_id),)
+            ).fetchall()
+        else:
+            rows = self._conn().execute(
+                "SELECT entry FROM (SELECT seq, entry FROM log_entries WHERE user_id = ? "
+                "ORDER BY seq DESC LIMIT ?) ORDER BY seq", (str(user_id), last_n)
+            ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def save_user_log(self, user_id, log: list):
+        with self.locked():
+            conn = self._conn()
+            conn.execute("DELETE FROM log_entries WHERE user_id = ?", (str(user_id),))
+            conn.executemany(
+                "INSERT INTO log_entries (user_id, seq, entry) VALUES (?, ?, ?)",
+                [(str(user_id), i, json.dumps(e, ensure_ascii=False)) for i, e in enumerate(log)]
+            )
+
+    def append_log_entry(self, user_id, entry: dict):
+        self._conn().execute(
+            "INSERT INTO log_entries (user_id, seq, entry) VALUES "
+            "(?, (SELECT COALESCE(MAX(seq), -1) + 1 FROM log_entries WHERE user_id = ?), ?)",
+            (str(user_id), str(user_id), json.dumps(entry, ensure_ascii=False))
+        )
+
+    def last_log_entry(self, user_id):
+        log = self.load_user_log(user_id, last_n=1)
+        return log[0] if log else None
+
+    # user configs
+    def load_config(self, user_id) -> dict:
+        row = self._conn().execute(
+            "SELECT config FROM user_configs WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_config(self, user_id, config: dict):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO user_configs (user_id, config) VALUES (?, ?)",
+            (str(user_id), json.dumps(config, ensure_ascii=False))
+        )
+
+    # session keys
+    def load_key(self, user_id):
+        row = self._conn().execute(
+            "SELECT key FROM user_keys WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def save_key_if_absent(self, user_id, key: bytes) -> bytes:
+        with self.locked():
+            self._conn().execute(
+                "INSERT OR IGNORE INTO user_keys (user_id, key) VALUES (?, ?)", (str(user_id), key)
+            )
+            return self.load_key(user_id)
+
+    # export registry
+    def get_export(self, token: str):
+        row = self._conn().execute("SELECT meta FROM exports WHERE token = ?", (token,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_export(self, token: str, meta: dict):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO exports (token, user_id, revoke_id, meta) VALUES (?, ?, ?, ?)",
+            (token, str(meta.get("user_id")), str(meta.get("revoke_id")), json.dumps(meta, ensure_ascii=False))
+        )
+
+    def delete_export(self, token: str) -> bool:
+        cur = self._conn().execute("DELETE FROM exports WHERE token = ?", (token,))
+        return cur.rowcount > 0
+
+    def find_export(self, user_id, revoke_id: str):
+        row = self._conn().execute(
+            "SELECT token, meta FROM exports WHERE user_id = ? AND revoke_id = ? LIMIT 1",
+            (str(user_id), str(revoke_id))
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def list_exports(self) -> dict:
+        rows = self._conn().execute("SELECT token, meta FROM exports").fetchall()
+        return {token: json.loads(meta) for token, meta in rows}
+
+    # one-time migrations
+    def has_marker(self, name: str) -> bool:
+        return self._conn().execute("SELECT 1 FROM markers WHERE name = ?", (name,)).fetchone() is not None
+
+    def set_marker(self, name: str):
+        self._conn().execute("INSERT OR IGNORE INTO markers (name) VALUES (?)", (name,))
+
+
+_BACKENDS = {
+    "sqlite": lambda: SQLiteStorage(STORAGE_DB_PATH, timeout=STORAGE_LOCK_TIMEOUT_SEC),
+}
+_STORAGE = None
+_STORAGE_INIT_LOCK = threading.Lock()
+
+
+def get_storage() -> StorageBackend:
+    """Returns the process-wide storage backend selected by STORAGE_BACKEND."""
+    global _STORAGE
+    if _STORAGE is None:
+        with _STORAGE_INIT_LOCK:
+            if _STORAGE is None:
+                if STORAGE_BACKEND not in _BACKENDS:
+                    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+                _STORAGE = _BACKENDS[STORAGE_BACKEND]()
+    return _STORAGE
+
+
+_LEGACY_IMPORT_MARKER = "legacy_files_imported_v1"
+
+
+def import_legacy_files(storage: StorageBackend = None, data_dir: str = DATA_DIR) -> int:
+    """
+    Purpose: One-time import of the old file layout under DATA_DIR
+    (<user_id>.json, <user_id>_config.json, user_keys/<user_id>.key, exports_registry.json).
+    Records that already exist in the backend are left untouched. A marker is stored with the
+    import, so later calls do nothing: links revoked or used up after the import are never
+    brought back from the stale legacy registry.
+
+    Returns:
+        Number of imported records (0 if the import already ran).
+    """
+    storage = storage or get_storage()
+    imported = 0
+
+    def _read_json(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Skipping unreadable legacy file {path}: {e}")
+            return None
+
+    with storage.locked():
+        if storage.has_marker(_LEGACY_IMPORT_MARKER):
+            return 0
+
+        for name in os.listdir(data_dir):
+            path = os.path.join(data_dir, name)
+            m = re.fullmatch(r"(-?\d+)\.json", name)
+            if m and storage.last_log_entry(m.group(1)) is None:
+                log = _read_json(path)
+                if log:
+                    storage.save_user_log(m.group(1), log)
+                    imported += 1
+                continue
+            m = re.fullmatch(r"(-?\d+)_config\.json", name)
+            if m and not storage.load_config(m.group(1)):
+                config = _read_json(path)
+                if config:
+                    storage.save_config(m.group(1), config)
+                    imported += 1
+
+        key_dir = os.path.join(data_dir, "user_keys")
+        if os.path.isdir(key_dir):
+            for name in os.listdir(key_dir):
+                m = re.fullmatch(r"(-?\d+)\.key", name)
+                if m and storage.load_key(m.group(1)) is None:
+                    with open(os.path.join(key_dir, name), "rb") as f:
+                        storage.save_key_if_absent(m.group(1), f.read())
+                    imported += 1
+
+        registry_path = os.path.join(data_dir, "exports_registry.json")
+        if os.path.exists(registry_path):
+            for token, meta in (_read_json(registry_path) or {}).items():
+                if storage.get_export(token) is None:
+                    storage.put_export(token, meta)
+                    imported += 1
+
+        storage.set_marker(_LEGACY_IMPORT_MARKER)
+
+    if imported:
+        logging.info(f"Imported {imported} legacy records into the storage backend.")
+    return imported
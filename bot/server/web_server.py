@@ -5,7 +5,9 @@ from flask import Flask, request, Response, send_file
 
 # Local module imports
 from bot.config import DELETE_AFTER_DOWNLOAD, OTP_ATTEMPT_LIMIT
-from bot.core.export_handler import _verify_token, _load_registry, _save_registry, hash_otp, revoke_secure_link
+from bot.core.export_handler import (
+    _verify_token, _get_export, _put_export, _delete_export, registry_lock, hash_otp, revoke_secure_link
+)
 
 web_app = Flask(__name__)
 
@@ -39,8 +41,7 @@ def secure_download():
     if not token:
         return "Invalid or tampered token.", 403
 
-    reg = _load_registry()
-    meta = reg.get(token)
+    meta = _get_export(token)
     if not meta:
         return Response("Invalid or revoked link.", status=410)
     if meta.get("locked"):
@@ -53,42 +54,49 @@ def secure_download():
     if not otp_input:
         return _render_otp_form(signed, error="OTP is required.")
 
-    if hash_otp(otp_input) != meta.get("otp_hash"):
-        meta["otp_attempts"] = meta.get("otp_attempts", 0) + 1
-        if meta["otp_attempts"] >= OTP_ATTEMPT_LIMIT:
-            meta["locked"] = True
-        _save_registry({**reg, token: meta})
-        left = max(0, OTP_ATTEMPT_LIMIT - meta["otp_attempts"])
-        return _render_otp_form(signed, error=f"Invalid OTP. Attempts left: {left}")
-
     client_ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-    if meta.get("ip_lock") is None:
-        meta["ip_lock"] = client_ip
-    elif meta["ip_lock"] != client_ip:
-        logging.warning(f"IP mismatch for token {token[:8]}... Expected {meta['ip_lock']}, got {client_ip}")
-        return Response("IP not allowed for this link.", status=403)
 
-    if meta["downloads"] >= meta.get("max_downloads", 1):
-        return Response("Download limit reached.", status=410)
+    # Re-read and update the entry under the registry lock so concurrent workers never lose an attempt or a download
+    with registry_lock():
+        meta = _get_export(token)
+        if not meta:
+            return Response("Invalid or revoked link.", status=410)
+        if meta.get("locked"):
+            return Response("This link is locked due to too many invalid attempts.", status=423)
+
+        if hash_otp(otp_input) != meta.get("otp_hash"):
+            meta["otp_attempts"] = meta.get("otp_attempts", 0) + 1
+            if meta["otp_attempts"] >= OTP_ATTEMPT_LIMIT:
+                meta["locked"] = True
+            _put_export(token, meta)
+            left = max(0, OTP_ATTEMPT_LIMIT - meta["otp_attempts"])
+            return _render_otp_form(signed, error=f"Invalid OTP. Attempts left: {left}")
+
+        if meta.get("ip_lock") is None:
+            meta["ip_lock"] = client_ip
+        elif meta["ip_lock"] != client_ip:
+            logging.warning(f"IP mismatch for token {token[:8]}... Expected {meta['ip_lock']}, got {client_ip}")
+            return Response("IP not allowed for this link.", status=403)
+
+        if meta["downloads"] >= meta.get("max_downloads", 1):
+            return Response("Download limit reached.", status=410)
+
+        fpath = meta["file_path"]
+        if os.path.exists(fpath):
+            meta["downloads"] += 1
+            _put_export(token, meta)
 
-    fpath = meta["file_path"]
     if not os.path.exists(fpath):
         revoke_secure_link(token)
         return Response("File not found (possibly removed).", status=410)
 
-    meta["downloads"] += 1
-    _save_registry({**reg, token: meta})
-
     resp = send_file(fpath, as_attachment=True, download_name=os.path.basename(fpath))
 
     if meta["downloads"] >= meta.get("max_downloads", 1):
         if DELETE_AFTER_DOWNLOAD:
             revoke_secure_link(token)
         else: # If not deleting the file after download, only remove from the registry
-            reg = _load_registry()
-            if token in reg:
-                del reg[token]
-                _save_registry(reg)
+            _delete_export(token)
 
     return resp
 
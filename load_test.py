@@ -0,0 +1,355 @@
+"""
+Load-test harness for the Telegram handlers.
+
+Replays scripted multi-user conversations (chat messages mixed with /register, /send and /revoke)
+against bot/server/telegram_handlers.py with fake LLM and SMTP backends, for a sweep of concurrent
+user counts. For every level it prints throughput and latency percentiles (the saturation curve)
+and checks the stored data afterwards: hash chains, lost log entries, lost registry updates and
+lost config updates.
+
+Everything runs against a throw-away storage DB and export dir (removed at exit unless --keep);
+real user data is never touched. Op scripts, counselor emails and think times are drawn per user
+session, and fake LLM / SMTP latencies are derived from the request content, all seeded by --seed.
+With --sessions-per-user > 1 the interleaving of a user's sessions (and so the exported history)
+still depends on scheduling.
+
+Exit code: 1 if any level corrupted data, 2 if handler errors exceed --max-errors, else 0.
+
+Example:
+    python load_test.py --users 10,100,500,1000 --turns 6 --llm-latency 0.5 --pool-size 32
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import base64
+import atexit
+import shutil
+import random
+import asyncio
+import secrets
+import argparse
+import tempfile
+import statistics
+from types import SimpleNamespace
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+WORK_DIR = tempfile.mkdtemp(prefix="elog_load_")
+KEEP_WORK_DIR = False # set by --keep
+
+
+def _cleanup_work_dir():
+    if not KEEP_WORK_DIR:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+# Registered right away so --help, argparse errors and bad --mix values clean up too
+atexit.register(_cleanup_work_dir)
+
+# Must be set before the bot package is imported: config reads them at import time
+os.environ.update({
+    "AZURE_API_KEY": "load-test", "AZURE_API_ENDPOINT": "https://load-test.invalid",
+    "AZURE_DEPLOYMENT_NAME": "load-test", "TELEGRAM_BOT_TOKEN": "load-test",
+    "SMTP_EMAIL": "bot@load-test.invalid", "SMTP_PASSWORD": "load-test",
+    "MASTER_KEY": base64.b64encode(secrets.token_bytes(32)).decode(),
+    "SECRET_LINK_KEY": base64.b64encode(secrets.token_bytes(32)).decode(),
+    "STORAGE_DB_PATH": os.path.join(WORK_DIR, "init.db"),
+})
+os.chdir(PROJECT_ROOT) # prompt templates are loaded with relative paths
+
+# Local module imports
+from bot.core import storage, llm_handler, export_handler
+from bot.core.data_manager import load_user_log, load_counselor_email
+from bot.core.security_utils import decrypt_entries, compute_chain_hash
+from bot.server.telegram_handlers import (
+    send_logs_command, revoke_command, register_email_command, handle_message
+)
+
+REVOKE_ID_RE = re.compile(r"/revoke (ACT-\d{6}-[A-Z])")
+
+
+def fake_latency(seed: int, kind: str, request: str, mean: float) -> float:
+    """Latency drawn from the request itself, so it does not depend on which pool thread runs first."""
+    return random.Random(f"{seed}-{kind}-{request}").uniform(0.5, 1.5) * mean
+
+
+class FakeLLM:
+    """Stands in for the Azure OpenAI client: `chat.completions.create` sleeps, then echoes."""
+
+    def __init__(self, latency: float, seed: int):
+        self.latency = latency
+        self.seed = seed
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **kwargs):
+        time.sleep(fake_latency(self.seed, "llm", messages[-1]["content"], self.latency))
+        content = f"reply to: {messages[-1]['content'][-40:]}"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+def fake_smtp(latency: float, seed: int):
+    class FakeSMTP:
+        def __init__(self, host, port):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def login(self, user, password):
+            pass
+
+        def send_message(self, msg):
+            time.sleep(fake_latency(seed, "smtp", f"{msg['To']} {msg['Subject']}", latency))
+
+    return SimpleNamespace(SMTP_SSL=FakeSMTP)
+
+
+def fake_update(user_id: int, text: str, replies: list):
+    async def reply_text(msg, **kwargs):
+        replies.append(msg)
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        message=SimpleNamespace(text=text, reply_text=reply_text),
+    )
+
+
+def build_script(rng: random.Random, turns: int, mix: dict) -> list:
+    """Every conversation registers first, then plays `turns` operations drawn from `mix`."""
+    kinds, weights = zip(*mix.items())
+    return ["register"] + rng.choices(kinds, weights=weights, k=turns)
+
+
+class UserState:
+    """What the harness expects storage to contain for one user once the level is over."""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.messages = 0
+        self.emails = set()
+        self.live_revoke_ids = Counter()
+
+
+async def run_user(user_id, session, script, state, stats, gate, think_time, rng):
+    today = datetime.now(timezone.utc).date()
+    date_args = [str(today - timedelta(days=1)), str(today + timedelta(days=1))]
+
+    for turn, op in enumerate(script):
+        replies = []
+        if op == "message":
+            text = f"user {user_id} session {session} says hello #{turn}"
+            update, args = fake_update(user_id, text, replies), []
+            handler = handle_message
+        elif op == "register":
+            email = f"counselor{user_id}.{rng.getrandbits(16):04x}@example.com"
+            update, args = fake_update(user_id, f"/register {email}", replies), [email]
+            handler = register_email_command
+        elif op == "send":
+            update, args = fake_update(user_id, "/send", replies), date_args
+            handler = send_logs_command
+        else: # revoke
+            pending = [rid for rid, n in state.live_revoke_ids.items() if n > 0]
+            rid = pending[0] if pending else "ACT-000000-Z"
+            update, args = fake_update(user_id, f"/revoke {rid}", replies), [rid]
+            handler = revoke_command
+
+        async with gate:
+            started = time.perf_counter()
+            try:
+                await handler(update, SimpleNamespace(args=args))
+                ok = True
+            except Exception as e:
+                replies.append(f"harness: handler raised {e!r}")
+                ok = False
+            stats[op].append(time.perf_counter() - started)
+
+        reply = replies[-1] if replies else ""
+        if not ok or "error occurred" in reply:
+            stats["errors"].append(f"user {user_id} {op}: {reply}")
+        elif op == "message":
+            state.messages += 1
+        elif op == "register":
+            state.emails.add(email)
+        elif op == "send":
+            # Every path that exports nothing (no history, no email, bad dates) currently returns a
+            # 2-tuple that send_logs_command fails to unpack, so it is counted as an error above
+            m = REVOKE_ID_RE.search(reply)
+            if m:
+                state.live_revoke_ids[m.group(1)] += 1
+        elif op == "revoke" and "sucessfully deactivated" in reply:
+            state.live_revoke_ids[rid] -= 1
+
+        if think_time:
+            await asyncio.sleep(rng.uniform(0, think_time))
+
+
+def check_integrity(states: list) -> list:
+    """Compares storage with what the replayed conversations should have produced."""
+    violations = []
+    registry = defaultdict(Counter)
+    for meta in storage.get_storage().list_exports().values():
+        registry[int(meta["user_id"])][meta["revoke_id"]] += 1
+
+    for st in states:
+        uid = st.user_id
+        log = load_user_log(uid)
+
+        # Each answered message stores the user turn and the assistant turn
+        if len(log) != 2 * st.messages:
+            violations.append(f"user {uid}: {len(log)} log entries, expected {2 * st.messages} (lost updates)")
+
+        prev_hash = ""
+        for i, (e, (pt, err)) in enumerate(zip(log, decrypt_entries(uid, log))):
+            if err is not None:
+                violations.append(f"user {uid}: entry {i} cannot be decrypted ({err!r})")
+                break
+            expect = compute_chain_hash(prev_hash, e["timestamp"], e["role"], pt)
+            if e.get("chain_hash") != expect:
+                violations.append(f"user {uid}: hash chain broken at entry {i}")
+                break
+            prev_hash = e["chain_hash"]
+
+        # With several sessions per user any registered address may be the last write
+        if st.emails and load_counselor_email(uid) not in st.emails:
+            violations.append(f"user {uid}: counselor email lost (expected one of {sorted(st.emails)})")
+
+        expected = +st.live_revoke_ids # drops zero / negative counts
+        if registry.get(uid, Counter()) != expected:
+            violations.append(
+                f"user {uid}: registry has {dict(registry.get(uid, {}))}, expected {dict(expected)} (lost registry updates)"
+            )
+    return violations
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[q - 1]
+
+
+async def run_level(n_users, args, mix):
+    # Fresh storage and export dir per level so levels do not see each other's data
+    level_dir = os.path.join(WORK_DIR, f"users_{n_users}")
+    os.makedirs(level_dir, exist_ok=True)
+    storage._STORAGE = storage.SQLiteStorage(os.path.join(level_dir, "elog.db"))
+    export_handler.DATA_DIR = level_dir
+
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=args.pool_size))
+    gate = asyncio.Semaphore(args.update_concurrency or n_users * args.sessions_per_user)
+
+    script_rng = random.Random(args.seed + n_users)
+    states = [UserState(1_000_000 + i) for i in range(n_users)]
+    stats = defaultdict(list)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_user(st.user_id, session, build_script(script_rng, args.turns, mix), st, stats, gate, args.think_time,
+                 # One generator per session: a shared one would be drawn from in scheduling order
+                 random.Random(f"{args.seed}-{n_users}-{st.user_id}-{session}"))
+        for st in states for session in range(args.sessions_per_user)
+    ))
+    wall = time.perf_counter() - started
+
+    ops = sum(len(v) for k, v in stats.items() if k != "errors")
+    row = {
+        "users": n_users,
+        "ops": ops,
+        "wall_sec": round(wall, 3),
+        "throughput_ops_per_sec": round(ops / wall, 2) if wall else 0.0,
+        "errors": len(stats["errors"]),
+        "latency_sec": {
+            op: {"p50": round(percentile(sorted(v), 50), 4),
+                 "p95": round(percentile(sorted(v), 95), 4),
+                 "p99": round(percentile(sorted(v), 99), 4)}
+            for op, v in stats.items() if op != "errors"
+        },
+        "integrity_violations": check_integrity(states),
+        "error_samples": stats["errors"][:5],
+    }
+    return row
+
+
+def print_row(row):
+    lat = row["latency_sec"]
+    cols = " ".join(f"{op}={lat[op]['p50']:.3f}/{lat[op]['p95']:.3f}/{lat[op]['p99']:.3f}" for op in sorted(lat))
+    print(f"{row['users']:>7} {row['ops']:>7} {row['wall_sec']:>9.2f} {row['throughput_ops_per_sec']:>9.2f} "
+          f"{row['errors']:>6} {len(row['integrity_violations']):>10}  {cols}")
+    for v in row["integrity_violations"][:5]:
+        print(f"        VIOLATION {v}")
+    for e in row["error_samples"]:
+        print(f"        ERROR {e}")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Replay concurrent Telegram conversations against the bot handlers.")
+    p.add_argument("--users", default="10,50,100,500,1000", help="comma-separated concurrent user counts to sweep")
+    p.add_argument("--turns", type=int, default=6, help="operations per user after /register")
+    p.add_argument("--sessions-per-user", type=int, default=1,
+                   help="concurrent scripts per user; >1 makes a user's updates race each other")
+    p.add_argument("--mix", default="message=8,send=1,revoke=1,register=1", help="op weights, e.g. message=8,send=1")
+    p.add_argument("--llm-latency", type=float, default=0.2, help="mean fake LLM call latency (s)")
+    p.add_argument("--smtp-latency", type=float, default=0.1, help="mean fake SMTP send latency (s)")
+    p.add_argument("--pool-size", type=int, default=min(32, (os.cpu_count() or 1) + 4),
+                   help="asyncio.to_thread pool size (Python's default is min(32, cpus + 4))")
+    p.add_argument("--update-concurrency", type=int, default=0,
+                   help="max updates handled at once; 1 models ApplicationBuilder's default, 0 = unbounded")
+    p.add_argument("--think-time", type=float, default=0.0, help="max random pause between a user's turns (s)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--max-errors", type=int, default=0,
+                   help="handler errors tolerated over the whole run before exiting with code 2")
+    p.add_argument("--json", help="also write the results to this file")
+    p.add_argument("--keep", action="store_true", help="keep the work dir (DBs and export zips) after the run")
+    p.add_argument("--verbose", action="store_true", help="show the bot's own log output")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Handler failures are already counted per level; the bot's tracebacks would bury the table
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    mix = {k: float(v) for k, v in (item.split("=") for item in args.mix.split(","))}
+    unknown = set(mix) - {"message", "send", "revoke", "register"}
+    if unknown:
+        sys.exit(f"Unknown ops in --mix: {', '.join(sorted(unknown))}")
+
+    global KEEP_WORK_DIR
+    KEEP_WORK_DIR = args.keep
+
+    llm = FakeLLM(args.llm_latency, args.seed)
+    llm_handler.client = llm
+    export_handler.client = llm
+    export_handler.smtplib = fake_smtp(args.smtp_latency, args.seed)
+
+    print(f"work dir: {WORK_DIR}  pool size: {args.pool_size}  "
+          f"update concurrency: {args.update_concurrency or 'unbounded'}  sessions per user: {args.sessions_per_user}")
+    print(f"{'users':>7} {'ops':>7} {'wall(s)':>9} {'ops/s':>9} {'errors':>6} {'violations':>10}  latency p50/p95/p99 (s)")
+    results = []
+    for n in (int(x) for x in args.users.split(",")):
+        row = asyncio.run(run_level(n, args, mix))
+        print_row(row)
+        results.append(row)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "levels": results}, f, ensure_ascii=False, indent=2)
+
+    # Non-zero exit on corrupted data or too many handler errors, so the harness can gate CI runs
+    if any(r["integrity_violations"] for r in results):
+        return 1
+    if sum(r["errors"] for r in results) > args.max_errors:
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
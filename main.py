@@ -3,6 +3,7 @@ from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, fil
 
 # Local module imports
 from bot.config import TELEGRAM_BOT_TOKEN
+from bot.core.storage import import_legacy_files
 from bot.server.web_server import start_keep_alive
 from bot.server.telegram_handlers import (
     start,
@@ -33,6 +34,9 @@ if __name__ == "__main__":
         level=logging.INFO
     )
     
+    # Move data from the old per-file layout into the storage backend (no-op once done)
+    import_legacy_files()
+
     # Start the web server in a background thread
     start_keep_alive()
     logging.info("Flask web server started in the background.")